@@ -18,7 +18,6 @@ from streamlit.url_util import make_url_path
 from secure_auth_app import (
     session_store, 
     SecureOAuthManager, 
-    TokenInfo, 
     secure_user,
     init_oauth_flow,
     handle_oauth_callback
@@ -194,15 +193,15 @@ def secure_silent_login_and_get_user_info(app_name: str) -> Dict[str, Any]:
     
     # Get all active sessions (this is secure - only accessible within the process)
     # We'll iterate through sessions to find a valid one
-    for session_id, session_data in session_store._sessions.items():
+    # Iterate over a snapshot: refreshing a token goes through update_session, which may drop expired sessions
+    for session_id, session_data in list(session_store._sessions.items()):
         try:
             # Check if session is still valid
-            if time.time() < session_store._session_expiry.get(session_id, 0):
-                token_data = session_data.get('tokens')
+            if time.monotonic() < session_store._session_expiry.get(session_id, 0):
+                token_info = session_data.get('tokens')
                 oauth_manager = session_data.get('oauth_manager')
                 
-                if token_data and oauth_manager:
-                    token_info = TokenInfo(**token_data)
+                if token_info and oauth_manager:
                     
                     # Try to refresh token if expired
                     if token_info.is_expired and token_info.refresh_token:
@@ -210,8 +209,7 @@ def secure_silent_login_and_get_user_info(app_name: str) -> Dict[str, Any]:
                             new_token_info = oauth_manager.refresh_access_token(token_info.refresh_token)
                             token_info = new_token_info
                             # Update session with new token
-                            session_data['tokens'] = new_token_info.__dict__
-                            session_store.update_session(session_id, session_data)
+                            session_store.update_session(session_id, {'tokens': new_token_info})
                             print("Successfully refreshed access token")
                         except Exception as e:
                             print(f"Failed to refresh token: {e}")
@@ -1,10 +1,290 @@
-import pandas as pd
-from sogenai_chat_model import SocGenAIChatModel
+import asyncio
+import hashlib
+import inspect
+import json
+import random
+import re
+import sqlite3
+import threading
 import time
-from typing import Tuple # Import Tuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
+from functools import lru_cache
+from types import SimpleNamespace
+from typing import TYPE_CHECKING, List, Optional, Tuple # Import Tuple
+
+# numpy, pandas and the model SDK are only imported where they are used, so importing this
+# module for generate_with_retry & co. does not pay their start-up cost
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+    from sogenai_chat_model import SocGenAIChatModel
+
+# Opt-in (use_cache=True) on-disk cache of model responses, so unchanged narratives are not re-sent on every run.
+# Entries are JSON in SQLite: only the generated strings are stored, and reading the file never unpickles anything
+LLM_CACHE_PATH = ".llm_cache.sqlite3"
+LLM_CACHE_TTL = 24 * 3600.0 # Default seconds an entry is reused
+_cache_lock = threading.Lock() # One cache connection at a time within this process
+
+def _cache_connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(LLM_CACHE_PATH, timeout=10)
+    conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, expires_at REAL, texts TEXT NOT NULL)")
+    return conn
+
+def _cache_key(ai_model: "SocGenAIChatModel", prompts: list[str], generation_kwargs: Optional[dict] = None) -> str:
+    model_id = getattr(ai_model, 'model_name', None) or getattr(ai_model, 'model', None) or type(ai_model).__name__
+    payload = "\n".join([
+        str(model_id), str(getattr(ai_model, 'temperature', '')), json.dumps(generation_kwargs or {}, sort_keys=True)
+    ] + prompts)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _cache_get(key: str):
+    """Returns a response-like object (resp.generations[i][0].text) for a cached key, or None.
+    An unreadable cache counts as a miss."""
+    try:
+        with _cache_lock, closing(_cache_connect()) as conn:
+            row = conn.execute("SELECT expires_at, texts FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        expires_at, texts = row[0], json.loads(row[1])
+    except Exception as e:
+        print(f"LLM cache read failed, ignoring cache: {e}")
+        return None
+    if expires_at is not None and expires_at < time.time():
+        return None
+    if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        return None
+    return SimpleNamespace(generations=[[SimpleNamespace(text=text)] for text in texts])
+
+def _cache_set(key: str, resp, ttl: Optional[float] = LLM_CACHE_TTL) -> None:
+    # Only the generated texts are stored, not the SDK response object
+    texts = [generations[0].text for generations in resp.generations]
+    expires_at = time.time() + ttl if ttl is not None else None
+    try:
+        with _cache_lock, closing(_cache_connect()) as conn, conn: # inner 'with conn' commits
+            conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, expires_at, json.dumps(texts)))
+    except Exception as e:
+        print(f"LLM cache write failed, response not cached: {e}")
  
+@lru_cache(maxsize=1)
+def _get_token_encoding():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception: # tiktoken missing or its encoding files unavailable
+        return None
+
+def estimate_tokens(prompts: list[str]) -> int:
+    """Token count of the prompts via tiktoken when available, else a ~4 characters per token estimate."""
+    encoding = _get_token_encoding()
+    if encoding is not None:
+        return sum(len(encoding.encode(prompt)) for prompt in prompts)
+    return sum(len(prompt) for prompt in prompts) // 4 + 1
+
+class RateLimiter:
+    """Sliding-window limiter on requests and tokens per window, shared by the threaded and async callers,
+    so calls are paced below the provider's limits instead of tripping 429s and backing off.
+    Opt-in: build one with your provider's actual quota (requests and tokens per window) and pass it
+    as rate_limiter to process_schema_with_ai / generate_with_retry, or to ModelRouter for a pool."""
+
+    def __init__(self, rpm: int, tpm: int, window: float = 60.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = window
+        self._events = deque() # (timestamp, tokens) of calls inside the window
+        self._tokens_in_window = 0
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens: int) -> float:
+        """Records the call and returns 0 if it fits in the window, else the seconds to wait before retrying."""
+        with self._lock:
+            now = time.monotonic()
+            while self._events and self._events[0][0] <= now - self.window:
+                self._tokens_in_window -= self._events.popleft()[1]
+            # A single call larger than the whole token budget is let through once the window is empty
+            if not self._events or (len(self._events) < self.rpm and self._tokens_in_window + tokens <= self.tpm):
+                self._events.append((now, tokens))
+                self._tokens_in_window += tokens
+                return 0.0
+            return self._events[0][0] + self.window - now
+
+    def acquire(self, tokens: int) -> None:
+        wait = self._reserve(tokens)
+        while wait > 0:
+            time.sleep(wait)
+            wait = self._reserve(tokens)
+
+    async def acquire_async(self, tokens: int) -> None:
+        wait = self._reserve(tokens)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self._reserve(tokens)
+
+def _limiter_for(ai_model, rate_limiter: Optional[RateLimiter]) -> Optional[RateLimiter]:
+    # An explicit limiter wins; otherwise a ModelRouter paces against its own (if it was given one)
+    if rate_limiter is None and isinstance(ai_model, ModelRouter):
+        return ai_model.rate_limiter
+    return rate_limiter
+
+# Retry backoff: full jitter up to an exponentially growing, capped ceiling
+MAX_RETRY_WAIT = 30.0
+# Errors that a retry cannot fix (a call with bad arguments), raised immediately.
+# ValueError is not listed: JSON/Unicode decode errors and SDK errors subclass it and can be transient
+NON_RETRYABLE_ERRORS = (TypeError,)
+# 4xx statuses worth retrying (request timeout, rate limited); any other 4xx is a bad request that fails every time
+RETRYABLE_CLIENT_STATUSES = frozenset({408, 429})
+
+def _status_code(error: Exception) -> Optional[int]:
+    """HTTP status carried by an SDK/HTTP error (e.status_code, e.status or e.response.status_code), if any."""
+    for status in (getattr(error, 'status_code', None), getattr(error, 'status', None),
+                   getattr(getattr(error, 'response', None), 'status_code', None)):
+        if isinstance(status, int):
+            return status
+    return None
+
+def _is_retryable(error: Exception) -> bool:
+    """False for errors a retry cannot fix: NON_RETRYABLE_ERRORS and 4xx responses other than 408/429.
+    5xx, 429, timeouts and errors without a status are retried."""
+    if isinstance(error, NON_RETRYABLE_ERRORS):
+        return False
+    status = _status_code(error)
+    return status is None or not 400 <= status < 500 or status in RETRYABLE_CLIENT_STATUSES
+
+@lru_cache(maxsize=None)
+def _accepted_kwargs(model_type: type, method_name: str) -> Optional[frozenset]:
+    """Keyword arguments model_type.method_name accepts, or None if it takes **kwargs (or cannot be inspected)."""
+    try:
+        params = inspect.signature(getattr(model_type, method_name)).parameters.values()
+    except (AttributeError, TypeError, ValueError):
+        return None
+    if any(p.kind is inspect.Parameter.VAR_KEYWORD for p in params):
+        return None
+    return frozenset(p.name for p in params if p.kind in (inspect.Parameter.POSITIONAL_OR_KEYWORD, inspect.Parameter.KEYWORD_ONLY))
+
+def _supported_kwargs(ai_model, method_name: str, generation_kwargs: dict) -> dict:
+    # Model wrappers differ in which generation options they take; drop the ones this one does not
+    accepted = _accepted_kwargs(type(ai_model), method_name)
+    if accepted is None:
+        return generation_kwargs
+    return {k: v for k, v in generation_kwargs.items() if k in accepted}
+
+def _generate(ai_model, prompts: List[str], generation_kwargs: dict):
+    """ai_model.generate with the options it supports; retried without options if it rejects them."""
+    kwargs = _supported_kwargs(ai_model, 'generate', generation_kwargs)
+    try:
+        return ai_model.generate(prompts, **kwargs)
+    except TypeError:
+        if not kwargs:
+            raise
+        return ai_model.generate(prompts)
+
+async def _agenerate(ai_model, prompts: List[str], generation_kwargs: dict):
+    """Async counterpart of _generate, preferring ai_model.agenerate when the model has one."""
+    if not hasattr(ai_model, 'agenerate'):
+        return await asyncio.to_thread(_generate, ai_model, prompts, generation_kwargs)
+    kwargs = _supported_kwargs(ai_model, 'agenerate', generation_kwargs)
+    try:
+        return await ai_model.agenerate(prompts, **kwargs)
+    except TypeError:
+        if not kwargs:
+            raise
+        return await ai_model.agenerate(prompts)
+
+def _retry_wait(attempt: int, base_wait: float) -> float:
+    # Random delays keep concurrent callers that failed together from retrying in lockstep
+    return random.uniform(0, min(MAX_RETRY_WAIT, base_wait * (2 ** attempt)))
+
+# Number of section narratives summarised per request
+BATCH_ROWS = 8
+# Output caps for summaries: decoding time grows with output length, and a concise summary is short
+SUMMARY_MAX_TOKENS = 150
+SUMMARY_STOP = ["\n\n"]
+# Narratives with fewer words than this are not worth summarising
+MIN_SUMMARY_WORDS = 5
+_WORD_RE = re.compile(r'\S+')
+
+def has_min_words(text: str, min_words: int = MIN_SUMMARY_WORDS) -> bool:
+    """True if text has at least min_words words; stops scanning once enough are found."""
+    words = _WORD_RE.finditer(text)
+    return sum(1 for _ in zip(range(min_words), words)) >= min_words
+
+# Prompt templates, filled per section with str.format.
+# The instructions are a fixed leading prefix and all per-section text comes last, so every request
+# starts with the same bytes and is eligible for the provider's prompt-prefix cache.
+SUMMARY_PROMPT_TEMPLATE = "Please provide a concise summary of the following section narrative:\n\n{narrative}"
+BATCH_SUMMARY_HEADER = (
+    "Please provide a concise summary of each of the following section narratives.\n"
+    'Return only JSON of the form {"summaries": [{"id": <id>, "summary": "<summary>"}]}, '
+    "with exactly one entry per id."
+)
+BATCH_COUNT_TEMPLATE = "There are {count} sections, with ids 0 to {last_id}."
+BATCH_SECTION_TEMPLATE = "### Section id: {id}\n{narrative}"
+
+def build_summary_prompt(narrative: str) -> str:
+    return SUMMARY_PROMPT_TEMPLATE.format(narrative=narrative)
+
+def build_batch_summary_prompt(narratives: List[str]) -> str:
+    """Asks for one summary per narrative, returned as JSON keyed by the narrative's position."""
+    parts = [BATCH_SUMMARY_HEADER, BATCH_COUNT_TEMPLATE.format(count=len(narratives), last_id=len(narratives) - 1)]
+    parts.extend(BATCH_SECTION_TEMPLATE.format(id=position, narrative=narrative) for position, narrative in enumerate(narratives))
+    return "\n\n".join(parts)
+
+def parse_batch_summaries(text: str, count: int) -> Optional[List[str]]:
+    """Parses the JSON answer to a batched prompt; returns None unless every id 0..count-1 has a summary."""
+    text = text.strip()
+    if text.startswith("```"):
+        # Tolerate answers wrapped in a markdown code fence
+        text = text.strip("`")
+        if text.startswith("json"):
+            text = text[len("json"):]
+    try:
+        entries = json.loads(text)["summaries"]
+        by_id = {int(entry["id"]): str(entry["summary"]).strip() for entry in entries}
+    except (ValueError, KeyError, TypeError):
+        return None
+    if any(position not in by_id for position in range(count)):
+        return None
+    return [by_id[position] for position in range(count)]
+
+class SemanticSummaryCache:
+    """Reuses a stored summary when a new narrative embeds within `threshold` cosine similarity
+    of one summarised before. Needs sentence-transformers and faiss; entries live for the process."""
+
+    def __init__(self, model_name: str = 'all-MiniLM-L6-v2', threshold: float = 0.95):
+        # Optional heavy dependencies, only needed when a semantic cache is actually used
+        from sentence_transformers import SentenceTransformer
+        import faiss
+        self._embedder = SentenceTransformer(model_name)
+        self._index = faiss.IndexFlatIP(self._embedder.get_sentence_embedding_dimension())
+        self._summaries = []
+        self._lock = threading.Lock()
+        self.threshold = threshold
+
+    def embed(self, texts: List[str]) -> "np.ndarray":
+        import numpy as np
+        # Normalised embeddings make the inner product a cosine similarity
+        return np.asarray(self._embedder.encode(texts, normalize_embeddings=True), dtype='float32')
+
+    def lookup(self, vectors: "np.ndarray") -> List[Optional[str]]:
+        """Returns the cached summary for each vector, or None where nothing is close enough."""
+        with self._lock:
+            if self._index.ntotal == 0:
+                return [None] * len(vectors)
+            scores, ids = self._index.search(vectors, 1)
+            return [self._summaries[i[0]] if score[0] >= self.threshold else None for score, i in zip(scores, ids)]
+
+    def add(self, vector: "np.ndarray", summary: str) -> None:
+        with self._lock:
+            self._index.add(vector.reshape(1, -1))
+            self._summaries.append(summary)
+
 # Updated function signature and logic
-def process_schema_with_ai(sections_df: pd.DataFrame, paths_df: pd.DataFrame, ai_model: SocGenAIChatModel) -> Tuple[pd.DataFrame, pd.DataFrame]:
+def process_schema_with_ai(sections_df: "pd.DataFrame", paths_df: "pd.DataFrame", ai_model: "SocGenAIChatModel",
+                           max_concurrency: int = 8, batch_size: int = BATCH_ROWS,
+                           semantic_cache: Optional[SemanticSummaryCache] = None,
+                           rate_limiter: Optional[RateLimiter] = None,
+                           use_cache: bool = False) -> Tuple["pd.DataFrame", "pd.DataFrame"]:
     """
     Processes the parsed schema DataFrames using an AI model, primarily to generate
     summaries for root sections based on their full hierarchical narrative.
@@ -12,57 +292,144 @@ def process_schema_with_ai(sections_df: pd.DataFrame, paths_df: pd.DataFrame, ai
     Args:
         sections_df: DataFrame containing section information, including 'full_section_narrative' for roots.
         paths_df: DataFrame containing individual path information.
-        ai_model: An instance of the AI model for generation.
+        ai_model: An instance of the AI model for generation, or a ModelRouter over several.
+        max_concurrency: Maximum number of summary requests in flight at once.
+        batch_size: Number of section narratives packed into a single summary request.
+        semantic_cache: Optional SemanticSummaryCache; near-duplicate narratives reuse its summaries.
+        rate_limiter: Optional RateLimiter sized to the provider's quota; requests are not paced without one.
+        use_cache: Reuse responses from the on-disk cache at LLM_CACHE_PATH (for LLM_CACHE_TTL seconds) and store new ones.
 
     Returns:
         A tuple containing:
         - sections_df: The input sections DataFrame potentially updated with AI-generated summaries.
         - paths_df: The original paths DataFrame (as paths are not modified here).
     """
-    sections = sections_df.copy()
+    import numpy as np
+    import pandas as pd
+
+    # Shallow copy: the caller's frame is left untouched, but its column data is not duplicated
+    # (only the 'summary' column is assigned below)
+    sections = sections_df.copy(deep=False)
     # paths = paths_df.copy() # No longer modifying paths_df directly
 
     # 1. Summarize each root section using its full_section_narrative
     summaries = {} # Use dict for easier mapping back
     # Iterate through root sections that have a narrative generated
-    root_sections_with_narrative = sections[
-        sections['is_root'].fillna(False) & sections['full_section_narrative'].notna() & (sections['full_section_narrative'] != '')
-    ]
+    # Build the mask in one reduction over the raw arrays rather than chaining Series '&' temporaries
+    narrative_values = sections['full_section_narrative'].to_numpy()
+    has_root_narrative = np.logical_and.reduce([
+        sections['is_root'].fillna(False).to_numpy(dtype=bool),
+        pd.notna(narrative_values),
+        narrative_values != '',
+    ])
+    root_sections_with_narrative = sections[has_root_narrative]
 
     print(f"Generating summaries for {len(root_sections_with_narrative)} root sections...") # Add print statement
 
-    for index, sec in root_sections_with_narrative.iterrows():
-        sec_id = sec['section_id']
-        full_narrative = sec['full_section_narrative']
-
+    # Collect every narrative first so they can be batched and dispatched concurrently
+    # Identical narratives are sent once; every section sharing one gets the same summary
+    narratives = []
+    prompt_sections = [] # [(index, label), ...] of the sections sharing each narrative, in the same order
+    position_by_narrative = {}
+    # Read the needed columns as arrays instead of materialising a Series per row with iterrows()
+    section_ids = root_sections_with_narrative['section_id'].to_numpy()
+    labels = root_sections_with_narrative['label'].to_numpy() if 'label' in root_sections_with_narrative.columns else section_ids
+    for index, sec_id, label, full_narrative in zip(
+        root_sections_with_narrative.index, section_ids, labels,
+        root_sections_with_narrative['full_section_narrative'].to_numpy()
+    ):
         # Check if narrative is substantial enough to summarize
-        if not full_narrative or len(full_narrative.split()) < 5: # Skip very short/empty narratives
-             print(f"Skipping summary for section {sec.get('label', sec_id)} due to short narrative.")
+        if not full_narrative or not has_min_words(full_narrative): # Skip very short/empty narratives
+             print(f"Skipping summary for section {label} due to short narrative.")
              summaries[index] = "Narrative too short to summarize." # Placeholder or skip
              continue
 
-        prompt = (
-            "Please provide a concise summary of the following section narrative:\n\n"
-            f"{full_narrative}"
-        )
-        try:
-            print(f"Sending prompt for section: {sec.get('label', sec_id)}") # Debug print
-            resp = generate_with_retry(ai_model, [prompt])
-            summary = resp.generations[0][0].text.strip()
-            summaries[index] = summary
-            print(f"Received summary for section: {sec.get('label', sec_id)}") # Debug print
-        except Exception as e:
-            print(f"Error generating summary for section {sec.get('label', sec_id)}: {e}")
-            summaries[index] = f"Error during summary generation: {e}" # Store error message
+        position = position_by_narrative.get(full_narrative)
+        if position is None:
+            position_by_narrative[full_narrative] = len(narratives)
+            narratives.append(full_narrative)
+            prompt_sections.append([(index, label)])
+        else:
+            prompt_sections[position].append((index, label))
+
+    def record_summary(position, summary=None, error=None):
+        for index, label in prompt_sections[position]:
+            if error is not None:
+                print(f"Error generating summary for section {label}: {error}")
+                summaries[index] = f"Error during summary generation: {error}" # Store error message
+            else:
+                summaries[index] = summary
+                print(f"Received summary for section: {label}") # Debug print
+        if error is None and semantic_cache is not None:
+            semantic_cache.add(narrative_vectors[position], summary)
+
+    # Positions (into narratives) that still need the model
+    pending_positions = list(range(len(narratives)))
+    if semantic_cache is not None and narratives:
+        narrative_vectors = semantic_cache.embed(narratives)
+        pending_positions = []
+        for position, cached_summary in enumerate(semantic_cache.lookup(narrative_vectors)):
+            if cached_summary is None:
+                pending_positions.append(position)
+            else:
+                for index, label in prompt_sections[position]:
+                    summaries[index] = cached_summary
+                    print(f"Reused cached summary for similar section: {label}") # Debug print
+
+    if pending_positions:
+        # Pack up to batch_size narratives into each request; a lone narrative keeps the plain prompt
+        batches = [pending_positions[start:start + batch_size] for start in range(0, len(pending_positions), batch_size)]
+        batch_prompts = [
+            build_summary_prompt(narratives[batch[0]]) if len(batch) == 1
+            else build_batch_summary_prompt([narratives[position] for position in batch])
+            for batch in batches
+        ]
+        print(f"Sending {len(pending_positions)} section narratives in {len(batch_prompts)} requests (up to {max_concurrency} at a time)...") # Debug print
+        # Cap output length: one summary's worth of tokens per narrative; single summaries also stop at a blank line
+        batch_kwargs = [
+            {'max_tokens': SUMMARY_MAX_TOKENS, 'stop': SUMMARY_STOP} if len(batch) == 1
+            else {'max_tokens': SUMMARY_MAX_TOKENS * len(batch)}
+            for batch in batches
+        ]
+        results = dispatch_prompts(ai_model, batch_prompts, max_concurrency, batch_kwargs, rate_limiter, use_cache)
+
+        retry_positions = [] # Narratives whose batched answer could not be parsed
+        for batch, result in zip(batches, results):
+            if isinstance(result, Exception):
+                for position in batch:
+                    record_summary(position, error=result)
+                continue
+            text = result.generations[0][0].text
+            if len(batch) == 1:
+                record_summary(batch[0], text.strip())
+                continue
+            batch_summaries = parse_batch_summaries(text, len(batch))
+            if batch_summaries is None:
+                print(f"Could not parse batched summaries, retrying {len(batch)} sections one by one.")
+                retry_positions.extend(batch)
+                continue
+            for position, summary in zip(batch, batch_summaries):
+                record_summary(position, summary)
+
+        if retry_positions:
+            retry_prompts = [build_summary_prompt(narratives[position]) for position in retry_positions]
+            retry_kwargs = [{'max_tokens': SUMMARY_MAX_TOKENS, 'stop': SUMMARY_STOP}] * len(retry_prompts)
+            results = dispatch_prompts(ai_model, retry_prompts, max_concurrency, retry_kwargs, rate_limiter, use_cache)
+            for position, result in zip(retry_positions, results):
+                if isinstance(result, Exception):
+                    record_summary(position, error=result)
+                else:
+                    record_summary(position, result.generations[0][0].text.strip())
 
     # Add summaries to the sections DataFrame
     # Ensure the 'summary' column exists
-    if 'summary' not in sections.columns:
-        sections['summary'] = None # Or pd.NA
+    # (a fresh object column, copied if it already existed, so writes below never reach the caller's frame)
+    sections['summary'] = sections['summary'].astype(object) if 'summary' in sections.columns else None
 
-    # Map summaries back using the index
-    summary_series = pd.Series(summaries)
-    sections['summary'] = summary_series.combine_first(sections['summary']) # Update existing column, keeping old values if no new summary
+    # Write the new summaries by index label, keeping old values where there is no new summary
+    if summaries:
+        summary_index = list(summaries)
+        sections.loc[summary_index, 'summary'] = [summaries[index] for index in summary_index]
 
     print("Summary generation complete.")
 
@@ -71,19 +438,184 @@ def process_schema_with_ai(sections_df: pd.DataFrame, paths_df: pd.DataFrame, ai
     return sections, paths_df
 
 
-def generate_with_retry(ai_model: SocGenAIChatModel, prompts: list[str], retries: int = 3, base_wait: float = 1.0):
-    """Call ai_model.generate with retries on errors (e.g., rate limits)."""
+def generate_with_retry(ai_model: "SocGenAIChatModel", prompts: list[str], retries: int = 3, base_wait: float = 1.0,
+                        use_cache: bool = False, ttl: Optional[float] = LLM_CACHE_TTL, generation_kwargs: Optional[dict] = None,
+                        rate_limiter: Optional[RateLimiter] = None):
+    """Call ai_model.generate with retries on errors (e.g., rate limits); 4xx errors other than 408/429 are raised at once.
+    With use_cache, responses are cached on disk by model and prompts; ttl (seconds, None for no expiry) bounds how long an entry is reused.
+    generation_kwargs (e.g. max_tokens, stop) are passed to generate when its signature accepts them.
+    Calls are paced by rate_limiter when one is given."""
+    generation_kwargs = generation_kwargs or {}
+    key = _cache_key(ai_model, prompts, generation_kwargs) if use_cache else None
+    if key is not None:
+        cached = _cache_get(key)
+        if cached is not None:
+            return cached
+    limiter = _limiter_for(ai_model, rate_limiter)
+    tokens = estimate_tokens(prompts) if limiter is not None else 0
     for attempt in range(retries):
         try:
+            if limiter is not None:
+                limiter.acquire(tokens)
             # Assuming ai_model.generate returns an object with .generations[0][0].text
-            return ai_model.generate(prompts)
+            resp = _generate(ai_model, prompts, generation_kwargs)
         except Exception as e:
+            if not _is_retryable(e):
+                raise
             print(f"Attempt {attempt + 1} failed: {e}") # Add print for errors
             if attempt < retries - 1:
-                wait_time = base_wait * (2 ** attempt)
+                wait_time = _retry_wait(attempt, base_wait)
                 print(f"Retrying in {wait_time:.2f} seconds...")
                 time.sleep(wait_time)
                 continue
             else:
                 print("Max retries reached. Raising exception.")
                 raise
+        else:
+            # The cache write is outside the retry: a failed write must not discard a good response
+            if key is not None:
+                _cache_set(key, resp, ttl)
+            return resp
+
+
+async def async_generate_with_retry(ai_model: "SocGenAIChatModel", prompts: list[str], retries: int = 3, base_wait: float = 1.0,
+                                    use_cache: bool = False, ttl: Optional[float] = LLM_CACHE_TTL, generation_kwargs: Optional[dict] = None,
+                                    rate_limiter: Optional[RateLimiter] = None):
+    """Async counterpart of generate_with_retry. Uses ai_model.agenerate when the model has one,
+    otherwise runs the blocking ai_model.generate in a worker thread."""
+    generation_kwargs = generation_kwargs or {}
+    key = _cache_key(ai_model, prompts, generation_kwargs) if use_cache else None
+    if key is not None:
+        cached = _cache_get(key)
+        if cached is not None:
+            return cached
+    limiter = _limiter_for(ai_model, rate_limiter)
+    tokens = estimate_tokens(prompts) if limiter is not None else 0
+    for attempt in range(retries):
+        try:
+            if limiter is not None:
+                await limiter.acquire_async(tokens)
+            resp = await _agenerate(ai_model, prompts, generation_kwargs)
+        except Exception as e:
+            if not _is_retryable(e):
+                raise
+            print(f"Attempt {attempt + 1} failed: {e}") # Add print for errors
+            if attempt < retries - 1:
+                wait_time = _retry_wait(attempt, base_wait)
+                print(f"Retrying in {wait_time:.2f} seconds...")
+                await asyncio.sleep(wait_time)
+                continue
+            else:
+                print("Max retries reached. Raising exception.")
+                raise
+        else:
+            # The cache write is outside the retry: a failed write must not discard a good response
+            if key is not None:
+                _cache_set(key, resp, ttl)
+            return resp
+
+
+async def generate_concurrently(ai_model: "SocGenAIChatModel", prompts: List[str], max_concurrency: int = 8,
+                                generation_kwargs: Optional[List[dict]] = None, rate_limiter: Optional[RateLimiter] = None,
+                                use_cache: bool = False) -> list:
+    """Sends each prompt as its own request, at most max_concurrency at a time.
+    generation_kwargs, if given, holds one kwargs dict per prompt.
+    Returns one entry per prompt, in order: the model response, or the exception it raised."""
+    semaphore = asyncio.Semaphore(max_concurrency)
+    generation_kwargs = generation_kwargs or [None] * len(prompts)
+
+    async def _one(prompt, kwargs):
+        async with semaphore:
+            return await async_generate_with_retry(ai_model, [prompt], use_cache=use_cache, generation_kwargs=kwargs,
+                                                   rate_limiter=rate_limiter)
+
+    return await asyncio.gather(*(_one(prompt, kwargs) for prompt, kwargs in zip(prompts, generation_kwargs)), return_exceptions=True)
+
+
+def generate_in_threads(ai_model: "SocGenAIChatModel", prompts: List[str], max_workers: int = 8,
+                        generation_kwargs: Optional[List[dict]] = None, rate_limiter: Optional[RateLimiter] = None,
+                        use_cache: bool = False) -> list:
+    """Thread-pool fan-out for blocking SDKs: each prompt goes through generate_with_retry on a worker
+    thread (the GIL is released while waiting on the network). Same result shape as generate_concurrently."""
+    results = [None] * len(prompts)
+    generation_kwargs = generation_kwargs or [None] * len(prompts)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(generate_with_retry, ai_model, [prompt], use_cache=use_cache, generation_kwargs=kwargs,
+                            rate_limiter=rate_limiter): i
+            for i, (prompt, kwargs) in enumerate(zip(prompts, generation_kwargs))
+        }
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                results[futures[future]] = e
+    return results
+
+
+def dispatch_prompts(ai_model: "SocGenAIChatModel", prompts: List[str], max_concurrency: int = 8,
+                     generation_kwargs: Optional[List[dict]] = None, rate_limiter: Optional[RateLimiter] = None,
+                     use_cache: bool = False) -> list:
+    """Sends prompts concurrently: asyncio for models with a native agenerate, a thread pool otherwise."""
+    if hasattr(ai_model, 'agenerate'):
+        return asyncio.run(generate_concurrently(ai_model, prompts, max_concurrency, generation_kwargs, rate_limiter, use_cache))
+    return generate_in_threads(ai_model, prompts, max_concurrency, generation_kwargs, rate_limiter, use_cache)
+
+
+class ModelRouter:
+    """Spreads requests over several models so one throttled provider does not stall the run.
+    Each call goes to an available model picked with weight inversely proportional to its recent
+    latency (EWMA); a model whose call fails is rested for `cooldown` seconds.
+    Can be passed anywhere a single ai_model is expected; rate_limiter, if given, paces the whole pool
+    (size it to the models' combined quota)."""
+
+    def __init__(self, models: list, cooldown: float = 30.0, alpha: float = 0.3,
+                 rate_limiter: Optional[RateLimiter] = None):
+        if not models:
+            raise ValueError("ModelRouter needs at least one model")
+        self.models = list(models)
+        self.cooldown = cooldown
+        self.alpha = alpha
+        self._latency = [None] * len(self.models) # EWMA of seconds per call, None until first success
+        self._cooling_until = [0.0] * len(self.models)
+        self._lock = threading.Lock()
+        self.rate_limiter = rate_limiter
+        # Identifies the pool in the response cache key
+        self.model_name = "router:" + ",".join(
+            str(getattr(model, 'model_name', None) or getattr(model, 'model', None) or type(model).__name__)
+            for model in self.models
+        )
+
+    def _choose(self) -> int:
+        with self._lock:
+            now = time.monotonic()
+            available = [i for i, until in enumerate(self._cooling_until) if until <= now]
+            if not available: # Everything is cooling down: use the one that recovers first
+                return min(range(len(self.models)), key=self._cooling_until.__getitem__)
+            known = [self._latency[i] for i in available if self._latency[i] is not None]
+            # Untried models are weighted like the fastest known one, so they get sampled too
+            default = min(known) if known else 1.0
+            weights = [1.0 / max(default if self._latency[i] is None else self._latency[i], 1e-3) for i in available]
+            return random.choices(available, weights)[0]
+
+    def _record(self, i: int, latency: Optional[float] = None) -> None:
+        with self._lock:
+            if latency is None:
+                self._cooling_until[i] = time.monotonic() + self.cooldown
+            elif self._latency[i] is None:
+                self._latency[i] = latency
+            else:
+                self._latency[i] = self.alpha * latency + (1 - self.alpha) * self._latency[i]
+
+    def generate(self, prompts: List[str], **generation_kwargs):
+        i = self._choose()
+        start = time.monotonic()
+        try:
+            resp = _generate(self.models[i], prompts, generation_kwargs)
+        except Exception as e:
+            if _is_retryable(e):
+                # Likely throttled or down; generate_with_retry's next attempt picks another model
+                self._record(i)
+            raise
+        self._record(i, time.monotonic() - start)
+        return resp
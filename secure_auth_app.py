@@ -1,83 +1,118 @@
 import streamlit as st
+import base64
 import json
 import secrets
 import time
 import hashlib
 import hmac
-from typing import Any, Dict, Optional, Tuple
+import heapq
+import re
+import threading
+import weakref
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, Optional, Tuple
 from urllib.parse import urlencode, parse_qs
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 
-import tornado.web
-import tornado.ioloop
 import requests
-from authlib.integrations.base_client import OAuthError
-from authlib.integrations.requests_client import OAuth2Session
-from authlib.oauth2.rfc6749 import OAuth2Token
-from authlib.oidc.core import CodeIDToken
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+# Authlib is imported where it is used, so workers that never run a login don't load it
 
 # Import Streamlit's internal components for proper redirects
 from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
 from streamlit.runtime.scriptrunner_utils.script_run_context import get_script_run_ctx
 
+# orjson parses the small provider JSON payloads faster; both accept bytes
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# Shared HTTP session: keeps connections to the identity provider alive between calls
+_HTTP = requests.Session()
+_HTTP.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=64,
+                                    max_retries=Retry(total=2, backoff_factor=0.1)))
+
+# Well-known identity providers, recognised from the server metadata URL
+_PROVIDER_RE = re.compile(r'google|microsoft|okta|auth0', re.I)
+_PROVIDER_INFO = {
+    'google': ("Google", "🔍"),
+    'microsoft': ("Microsoft", "🏢"),
+    'okta': ("Okta", "🛡️"),
+    'auth0': ("Auth0", "🔐"),
+}
+
 # Secure in-memory session storage
 class SecureSessionStore:
     """Secure in-memory session storage with automatic cleanup."""
     
     def __init__(self):
         self._sessions: Dict[str, Dict[str, Any]] = {}
+        # Expiry times are on the time.monotonic() clock, immune to wall-clock jumps;
+        # created_at / last_accessed stay wall-clock timestamps
         self._session_expiry: Dict[str, float] = {}
-        self._cleanup_interval = 300  # 5 minutes
-        self._last_cleanup = time.time()
-    
-    def _cleanup_expired_sessions(self):
-        """Remove expired sessions."""
-        now = time.time()
-        if now - self._last_cleanup < self._cleanup_interval:
-            return
-            
-        expired_sessions = [
-            session_id for session_id, expiry_time in self._session_expiry.items()
-            if now > expiry_time
-        ]
-        
-        for session_id in expired_sessions:
-            self._sessions.pop(session_id, None)
-            self._session_expiry.pop(session_id, None)
-        
-        self._last_cleanup = now
+        # Min-heap of (expiry_time, session_id); entries for deleted sessions are skipped when popped
+        self._expiry_heap: List[Tuple[float, str]] = []
+    
+    def _cleanup_expired_sessions(self, now: Optional[float] = None):
+        """Remove expired sessions (only pops the heap entries that are due)."""
+        if now is None:
+            now = time.monotonic()
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            expiry_time, session_id = heapq.heappop(self._expiry_heap)
+            if self._session_expiry.get(session_id) == expiry_time:
+                self._sessions.pop(session_id, None)
+                self._session_expiry.pop(session_id, None)
     
     def create_session(self, user_id: str, session_data: Dict[str, Any], ttl_seconds: int = 3600) -> str:
         """Create a new session and return session ID."""
-        self._cleanup_expired_sessions()
+        now = time.monotonic()
+        wall = time.time()
+        self._cleanup_expired_sessions(now)
         
         # Generate a cryptographically secure session ID
         session_id = secrets.token_urlsafe(32)
-        expiry_time = time.time() + ttl_seconds
+        expiry_time = now + ttl_seconds
         
         self._sessions[session_id] = {
             'user_id': user_id,
-            'created_at': time.time(),
-            'last_accessed': time.time(),
+            'created_at': wall,
+            'last_accessed': wall,
             **session_data
         }
         self._session_expiry[session_id] = expiry_time
+        heapq.heappush(self._expiry_heap, (expiry_time, session_id))
         
         return session_id
     
-    def get_session(self, session_id: str) -> Optional[Dict[str, Any]]:
-        """Get session data and update last access time."""
-        self._cleanup_expired_sessions()
+    def get_session(self, session_id: str) -> Optional[Mapping[str, Any]]:
+        """Get a read-only view of the session data and update last access time.
+        Use update_session to change it."""
+        now = time.monotonic()
+        self._cleanup_expired_sessions(now)
         
         if session_id in self._sessions and session_id in self._session_expiry:
             # Check if session is still valid
-            if time.time() < self._session_expiry[session_id]:
+            if now < self._session_expiry[session_id]:
                 self._sessions[session_id]['last_accessed'] = time.time()
-                return self._sessions[session_id].copy()
+                return MappingProxyType(self._sessions[session_id])
         
         return None
     
+    def touch(self, session_id: str) -> Optional[Mapping[str, Any]]:
+        """Hot-path get_session for per-rerun reads: same result, but leaves expired-session
+        cleanup to create_session/update_session."""
+        expiry_time = self._session_expiry.get(session_id)
+        if expiry_time is None or time.monotonic() >= expiry_time:
+            return None
+        session = self._sessions[session_id]
+        session['last_accessed'] = time.time()
+        return MappingProxyType(session)
+    
     def update_session(self, session_id: str, data: Dict[str, Any]) -> bool:
         """Update session data."""
         self._cleanup_expired_sessions()
@@ -95,9 +130,9 @@ class SecureSessionStore:
         self._session_expiry.pop(session_id, None)
         return deleted
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class TokenInfo:
-    """Secure token information container."""
+    """Secure token information container (stored as-is in the session, immutable)."""
     access_token: str
     token_type: str = "Bearer"
     expires_in: Optional[int] = None
@@ -105,40 +140,49 @@ class TokenInfo:
     scope: Optional[str] = None
     id_token: Optional[str] = None
     issued_at: float = None
+    # Computed once here, since is_expired is read on every rerun
+    _expires_at: Optional[float] = field(init=False, default=None, repr=False, compare=False)
     
     def __post_init__(self):
         if self.issued_at is None:
-            self.issued_at = time.time()
+            object.__setattr__(self, 'issued_at', time.time())
+        if self.expires_in is not None:
+            object.__setattr__(self, '_expires_at', self.issued_at + self.expires_in)
     
     @property
     def is_expired(self) -> bool:
         """Check if the access token is expired."""
-        if self.expires_in is None:
-            return False
-        return (time.time() - self.issued_at) >= self.expires_in
+        return self._expires_at is not None and time.time() >= self._expires_at
     
     @property
     def expires_at(self) -> Optional[float]:
         """Get the expiration timestamp."""
-        if self.expires_in is None:
-            return None
-        return self.issued_at + self.expires_in
+        return self._expires_at
 
 class SecureOAuthManager:
     """Secure OAuth manager using Authlib."""
     
+    # Server metadata per discovery URL, shared by all instances: {url: (metadata, expiry_time)}
+    _metadata_cache: Dict[str, Tuple[Dict[str, Any], float]] = {}
+    _metadata_ttl = 3600  # 1 hour
+    # Every claim the dashboard reads; the userinfo call is only skipped when the ID token carries all of them
+    _required_claims = frozenset({'sub', 'email', 'name', 'picture', 'given_name', 'family_name', 'locale'})
+    
     def __init__(self, client_id: str, client_secret: str, server_metadata_url: str, 
-                 redirect_uri: str, scopes: str = "openid profile email"):
+                 redirect_uri: str, scopes: str = "openid profile email",
+                 skip_userinfo_if_id_token_complete: bool = False):
         self.client_id = client_id
         self.client_secret = client_secret
         self.server_metadata_url = server_metadata_url
         self.redirect_uri = redirect_uri
         self.scopes = scopes
+        self.skip_userinfo_if_id_token_complete = skip_userinfo_if_id_token_complete
         
         # Fetch server metadata
         self._server_metadata = self._fetch_server_metadata()
         
         # Create OAuth2 session
+        from authlib.integrations.requests_client import OAuth2Session
         self.oauth = OAuth2Session(
             client_id=client_id,
             client_secret=client_secret,
@@ -147,13 +191,20 @@ class SecureOAuthManager:
         )
     
     def _fetch_server_metadata(self) -> Dict[str, Any]:
-        """Fetch OAuth server metadata."""
+        """Fetch OAuth server metadata (cached per URL for _metadata_ttl seconds)."""
+        cached = self._metadata_cache.get(self.server_metadata_url)
+        if cached and time.time() < cached[1]:
+            return cached[0]
+        
         try:
-            response = requests.get(self.server_metadata_url, timeout=10)
+            response = _HTTP.get(self.server_metadata_url, timeout=10)
             response.raise_for_status()
-            return response.json()
+            metadata = _json_loads(response.content)
         except Exception as e:
             raise ValueError(f"Failed to fetch server metadata: {e}")
+        
+        self._metadata_cache[self.server_metadata_url] = (metadata, time.time() + self._metadata_ttl)
+        return metadata
     
     def get_authorization_url(self, state: str) -> Tuple[str, str]:
         """Generate authorization URL with state parameter."""
@@ -178,6 +229,7 @@ class SecureOAuthManager:
         if not token_endpoint:
             raise ValueError("No token endpoint in server metadata")
         
+        from authlib.integrations.base_client import OAuthError
         try:
             token = self.oauth.fetch_token(
                 token_endpoint,
@@ -202,6 +254,7 @@ class SecureOAuthManager:
         if not token_endpoint:
             raise ValueError("No token endpoint in server metadata")
         
+        from authlib.integrations.base_client import OAuthError
         try:
             token = self.oauth.refresh_token(
                 token_endpoint,
@@ -232,9 +285,9 @@ class SecureOAuthManager:
         }
         
         try:
-            response = requests.get(userinfo_endpoint, headers=headers, timeout=10)
+            response = _HTTP.get(userinfo_endpoint, headers=headers, timeout=10)
             response.raise_for_status()
-            return response.json()
+            return _json_loads(response.content)
         except Exception as e:
             print(f"Warning: Failed to fetch userinfo: {e}")
             return {}
@@ -243,22 +296,34 @@ class SecureOAuthManager:
         """Parse and validate ID token (simplified - in production use proper JWT validation)."""
         try:
             # In production, properly validate the JWT signature
-            import base64
-            
             # Split JWT parts
             parts = id_token.split('.')
             if len(parts) != 3:
                 raise ValueError("Invalid JWT format")
             
-            # Decode payload (add padding if needed)
-            payload = parts[1]
-            payload += '=' * (4 - len(payload) % 4)
-            decoded = base64.urlsafe_b64decode(payload)
+            # Decode payload (add padding if needed; none when already a multiple of 4)
+            payload = parts[1].encode('ascii')
+            payload += b'=' * (-len(payload) % 4)
             
-            return json.loads(decoded)
+            return _json_loads(base64.urlsafe_b64decode(payload))
         except Exception as e:
             print(f"Warning: Failed to parse ID token: {e}")
             return {}
+    
+    def get_user_claims(self, token_info: TokenInfo) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Fetch userinfo and parse the ID token; returns (userinfo, id_token_claims).
+        userinfo is {} when skipping is enabled (off by default, so every refresh sees live userinfo)
+        and the ID token already has the required claims."""
+        if self.skip_userinfo_if_id_token_complete and token_info.id_token:
+            # Decoding is cheap next to a round-trip, so decode first and only ask userinfo for what is missing
+            id_token_claims = self.parse_id_token(token_info.id_token)
+            if self._required_claims.issubset(id_token_claims):
+                return {}, id_token_claims
+            return self.get_userinfo(token_info.access_token), id_token_claims
+        
+        userinfo = self.get_userinfo(token_info.access_token)
+        id_token_claims = self.parse_id_token(token_info.id_token) if token_info.id_token else {}
+        return userinfo, id_token_claims
 
 # Global secure session store
 session_store = SecureSessionStore()
@@ -266,43 +331,75 @@ session_store = SecureSessionStore()
 class SecureAuthenticatedUser:
     """Secure user info proxy that fetches live data."""
     
+    # User data per session ID, shared by all instances: {session_id: (data, expiry_time)},
+    # least recently used first. Every session's thread reads and writes it, so all access holds _user_cache_lock
+    _user_cache: "OrderedDict[str, Tuple[Dict[str, Any], float]]" = OrderedDict()
+    _user_cache_max = 1024
+    _user_cache_lock = threading.Lock()
+    # One refresh lock per session ID, so concurrent reruns of a session refresh once.
+    # Held weakly: an entry lives only while some rerun holds the lock, so expired or
+    # abandoned sessions leave nothing behind.
+    _refresh_locks: "weakref.WeakValueDictionary[str, threading.Lock]" = weakref.WeakValueDictionary()
+    _refresh_locks_guard = threading.Lock()
+    
     def __init__(self):
-        self._cached_data = None
-        self._cache_expiry = 0
         self._cache_duration = 300  # 5 minutes
+        # Keep-alive session for make_authenticated_request, reused across API calls
+        self._http = requests.Session()
+        self._http.mount("https://", HTTPAdapter(pool_maxsize=16))
+        self._http.mount("http://", HTTPAdapter(pool_maxsize=16))
+    
+    def _cache_user_data(self, session_id: str, data: Dict[str, Any]) -> None:
+        """Cache data for the session, evicting expired (then least recently used) entries when full."""
+        now = time.time()
+        with self._user_cache_lock:
+            cache = self._user_cache
+            cache[session_id] = (data, now + self._cache_duration)
+            cache.move_to_end(session_id)
+            if len(cache) > self._user_cache_max:
+                for sid in [sid for sid, (_, expiry) in cache.items() if expiry <= now]:
+                    del cache[sid]
+                while len(cache) > self._user_cache_max:
+                    cache.popitem(last=False)
+    
+    def _cached_user_data(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Unexpired cached data for the session (marking it most recently used), or None."""
+        with self._user_cache_lock:
+            cached = self._user_cache.get(session_id)
+            if cached is None or time.time() >= cached[1]:
+                return None
+            self._user_cache.move_to_end(session_id)
+            return cached[0]
+    
+    def _get_session_id(self) -> Optional[str]:
+        """Get the session ID from Streamlit's session state (read once per call and passed along)."""
+        return st.session_state.get('_secure_auth_session_id')
     
-    def _get_session_data(self) -> Optional[Dict[str, Any]]:
+    def _get_session_data(self, session_id: Optional[str]) -> Optional[Mapping[str, Any]]:
         """Get current session data from secure storage."""
-        # Get session ID from Streamlit's session state
-        session_id = getattr(st.session_state, '_secure_auth_session_id', None)
         if not session_id:
             return None
         
-        return session_store.get_session(session_id)
+        return session_store.touch(session_id)
     
-    def _refresh_cache(self) -> Dict[str, Any]:
+    def _refresh_cache(self, session_id: Optional[str]) -> Dict[str, Any]:
         """Refresh user data cache."""
-        session_data = self._get_session_data()
+        session_data = self._get_session_data(session_id)
         if not session_data:
             return {'is_logged_in': False}
         
         # Check if we have valid tokens
-        token_data = session_data.get('tokens')
+        token_info = session_data.get('tokens')
         oauth_manager = session_data.get('oauth_manager')
         
-        if not token_data or not oauth_manager:
+        if not token_info or not oauth_manager:
             return {'is_logged_in': False}
         
-        token_info = TokenInfo(**token_data)
-        
         # Refresh token if expired
         if token_info.is_expired and token_info.refresh_token:
             try:
                 new_token_info = oauth_manager.refresh_access_token(token_info.refresh_token)
-                session_store.update_session(
-                    getattr(st.session_state, '_secure_auth_session_id'),
-                    {'tokens': asdict(new_token_info)}
-                )
+                session_store.update_session(session_id, {'tokens': new_token_info})
                 token_info = new_token_info
             except Exception as e:
                 print(f"Failed to refresh token: {e}")
@@ -310,13 +407,9 @@ class SecureAuthenticatedUser:
         
         # Get fresh userinfo
         try:
-            userinfo = oauth_manager.get_userinfo(token_info.access_token)
+            userinfo, id_token_claims = oauth_manager.get_user_claims(token_info)
             
             # Combine ID token claims with fresh userinfo
-            id_token_claims = {}
-            if token_info.id_token:
-                id_token_claims = oauth_manager.parse_id_token(token_info.id_token)
-            
             combined_data = {
                 **id_token_claims,
                 **userinfo,
@@ -325,8 +418,7 @@ class SecureAuthenticatedUser:
                 'has_refresh_token': bool(token_info.refresh_token)
             }
             
-            self._cached_data = combined_data
-            self._cache_expiry = time.time() + self._cache_duration
+            self._cache_user_data(session_id, combined_data)
             
             return combined_data
             
@@ -335,32 +427,41 @@ class SecureAuthenticatedUser:
             return {'is_logged_in': False}
     
     def get_data(self) -> Dict[str, Any]:
-        """Get current user data with caching."""
-        if time.time() > self._cache_expiry or self._cached_data is None:
-            return self._refresh_cache()
-        return self._cached_data
+        """Get current user data with caching (per session ID, so a new login never sees stale data)."""
+        session_id = self._get_session_id()
+        if not session_id:
+            return {'is_logged_in': False}
+        
+        cached = self._cached_user_data(session_id)
+        if cached is not None:
+            return cached
+        
+        with self._refresh_locks_guard:
+            refresh_lock = self._refresh_locks.setdefault(session_id, threading.Lock())
+        with refresh_lock:
+            # Another rerun of this session may have refreshed while we waited
+            cached = self._cached_user_data(session_id)
+            if cached is not None:
+                return cached
+            return self._refresh_cache(session_id)
     
     def get_access_token(self) -> Optional[str]:
         """Get current access token."""
-        session_data = self._get_session_data()
+        session_id = self._get_session_id()
+        session_data = self._get_session_data(session_id)
         if not session_data:
             return None
         
-        token_data = session_data.get('tokens')
-        if not token_data:
+        token_info = session_data.get('tokens')
+        if not token_info:
             return None
         
-        token_info = TokenInfo(**token_data)
-        
         # Auto-refresh if expired
         if token_info.is_expired and token_info.refresh_token:
             try:
                 oauth_manager = session_data.get('oauth_manager')
                 new_token_info = oauth_manager.refresh_access_token(token_info.refresh_token)
-                session_store.update_session(
-                    getattr(st.session_state, '_secure_auth_session_id'),
-                    {'tokens': asdict(new_token_info)}
-                )
+                session_store.update_session(session_id, {'tokens': new_token_info})
                 return new_token_info.access_token
             except Exception as e:
                 print(f"Failed to refresh token: {e}")
@@ -379,21 +480,19 @@ class SecureAuthenticatedUser:
         kwargs['headers'] = headers
         
         try:
-            return requests.request(method, url, **kwargs)
+            return self._http.request(method, url, **kwargs)
         except Exception as e:
             print(f"Request failed: {e}")
             return None
     
     def logout(self):
         """Securely logout the user."""
-        session_id = getattr(st.session_state, '_secure_auth_session_id', None)
+        session_id = self._get_session_id()
         if session_id:
             session_store.delete_session(session_id)
-            if hasattr(st.session_state, '_secure_auth_session_id'):
-                del st.session_state._secure_auth_session_id
-        
-        self._cached_data = None
-        self._cache_expiry = 0
+            with self._user_cache_lock:
+                self._user_cache.pop(session_id, None)
+            st.session_state.pop('_secure_auth_session_id', None)
 
 # Create global user instance
 secure_user = SecureAuthenticatedUser()
@@ -458,7 +557,8 @@ def handle_oauth_callback(code: str, state: str) -> bool:
     """Handle OAuth callback and create session."""
     # Verify state parameter
     expected_state = getattr(st.session_state, '_oauth_state', None)
-    if not expected_state or state != expected_state:
+    # Constant-time comparison; encoded so non-ASCII input is rejected rather than raising
+    if not expected_state or not hmac.compare_digest(str(state).encode('utf-8'), expected_state.encode('utf-8')):
         st.error("Invalid state parameter. Please try logging in again.")
         return False
     
@@ -471,11 +571,8 @@ def handle_oauth_callback(code: str, state: str) -> bool:
         # Exchange code for tokens
         token_info = oauth_manager.exchange_code_for_tokens(code, state)
         
-        # Get user information
-        userinfo = oauth_manager.get_userinfo(token_info.access_token)
-        id_token_claims = {}
-        if token_info.id_token:
-            id_token_claims = oauth_manager.parse_id_token(token_info.id_token)
+        # Get user information (userinfo request overlaps the ID token parse)
+        userinfo, id_token_claims = oauth_manager.get_user_claims(token_info)
         
         # Create user ID from available claims
         user_id = (
@@ -494,7 +591,7 @@ def handle_oauth_callback(code: str, state: str) -> bool:
         session_id = session_store.create_session(
             user_id=user_id,
             session_data={
-                'tokens': asdict(token_info),
+                'tokens': token_info,
                 'oauth_manager': oauth_manager,
                 'userinfo': userinfo,
                 'id_token_claims': id_token_claims
@@ -559,19 +656,10 @@ def render_login_page():
         provider_name = "Company SSO"
         provider_icon = "🏢"
         
-        # Try to determine provider type from URL for better UX
-        if 'google' in server_url.lower():
-            provider_name = "Google"
-            provider_icon = "🔍"
-        elif 'microsoft' in server_url.lower():
-            provider_name = "Microsoft"
-            provider_icon = "🏢"
-        elif 'okta' in server_url.lower():
-            provider_name = "Okta"
-            provider_icon = "🛡️"
-        elif 'auth0' in server_url.lower():
-            provider_name = "Auth0"
-            provider_icon = "🔐"
+        # Try to determine provider type from URL for better UX (one scan for all known providers)
+        provider_match = _PROVIDER_RE.search(server_url)
+        if provider_match:
+            provider_name, provider_icon = _PROVIDER_INFO[provider_match.group(0).lower()]
         else:
             # Extract domain for custom providers
             try:
@@ -694,6 +782,7 @@ def render_user_dashboard():
                 if session_id:
                     session_data = session_store.get_session(session_id)
                     if session_data:
+                        session_data = dict(session_data)  # Mutable copy for the edits below
                         # Clear cached userinfo to force refresh
                         session_data.pop('cached_userinfo', None)
                         session_data.pop('cache_timestamp', None)
@@ -1,33 +1,137 @@
 import streamlit as st
+import asyncio
 import json
 import functools
+import hashlib
+import logging
 import os
 import tempfile
-from typing import Any, Dict
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Dict, Optional, Tuple
+import requests
+from requests.adapters import HTTPAdapter
 from streamlit.web.server.oauth_authlib_routes import AuthCallbackHandler, create_oauth_client
 
-# Use file-based storage that persists across processes
-STORAGE_DIR = tempfile.gettempdir()
-STORAGE_FILE = os.path.join(STORAGE_DIR, "streamlit_token_storage.json")
+# orjson is faster for the token file; both paths read and write bytes so the file format is the same
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def load_token_storage() -> Dict[str, Any]:
-    """Load token storage from file"""
+def _json_loads(data: bytes) -> Any:
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def _json_dumps(obj: Any) -> bytes:
+    return orjson.dumps(obj) if orjson else json.dumps(obj).encode('utf-8')
+
+# Debug output goes through logging, so it costs nothing unless DEBUG is enabled
+log = logging.getLogger(__name__)
+
+# Use file-based storage that persists across processes: one JSON file per user,
+# so a login or logout only touches that user's file
+STORAGE_DIR = os.path.join(tempfile.gettempdir(), "streamlit_tokens")
+
+def _derive_user_id(claims) -> Optional[str]:
+    """User key for the token files, from OIDC claims (userinfo dict or st.user)"""
+    return claims.get('sub') or claims.get('email') or claims.get('oid')
+
+def _user_token_path(user_id: str) -> str:
+    # Hashed so any user_id (email, URL-style sub, ...) is a safe file name
+    return os.path.join(STORAGE_DIR, hashlib.sha256(user_id.encode('utf-8')).hexdigest() + ".json")
+
+# Streamlit re-executes this script in a fresh namespace on every rerun, so state that has to
+# outlive one run is held by st.cache_resource (one object per process) rather than module globals
+@st.cache_resource
+def _token_cache() -> Dict[str, Tuple[Tuple[int, int], Dict[str, Any]]]:
+    """Parsed token files by path, as ((mtime_ns, size), data); reused until another write changes the file"""
+    return {}
+
+def load_user_token(user_id: str) -> Dict[str, Any]:
+    """Load one user's token record from file (parsed again only when the file has changed)"""
+    path = _user_token_path(user_id)
     try:
-        if os.path.exists(STORAGE_FILE):
-            with open(STORAGE_FILE, 'r') as f:
-                return json.load(f)
+        stat = os.stat(path)
+        cached = _token_cache().get(path)
+        if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+            return cached[1]
+        with open(path, 'rb') as f:
+            # Version of the file actually opened, so the cache key always matches the parsed bytes
+            stat = os.fstat(f.fileno())
+            record = _json_loads(f.read())
+        _token_cache()[path] = ((stat.st_mtime_ns, stat.st_size), record)
+        return record
+    except FileNotFoundError:
+        _token_cache().pop(path, None)
+        return {}
     except Exception as e:
-        print(f"DEBUG: Error loading token storage: {e}")
+        log.warning("Error loading token storage: %s", e)
     return {}
 
-def save_token_storage(storage: Dict[str, Any]) -> None:
-    """Save token storage to file"""
+@st.cache_resource
+def _storage_write_lock() -> threading.Lock:
+    """Serializes token-file writes (and their cache invalidation) across reruns and sessions"""
+    return threading.Lock()
+
+def save_user_token(user_id: str, record: Dict[str, Any]) -> None:
+    """Save one user's token record (atomically: readers see the old or the new file, never a partial one)"""
+    path = _user_token_path(user_id)
+    with _storage_write_lock():
+        _token_cache().pop(path, None) # Dropped first, so a failed write can't leave a stale cache behind
+        tmp_path = None
+        try:
+            os.makedirs(STORAGE_DIR, mode=0o700, exist_ok=True)
+            # Write a temp file next to the target and rename it over; no fsync, the tokens can be re-obtained
+            fd, tmp_path = tempfile.mkstemp(dir=STORAGE_DIR, prefix='tok-', suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_json_dumps(record))
+            os.replace(tmp_path, path)
+            tmp_path = None
+            log.debug("Saved token storage to %s", path)
+        except Exception as e:
+            log.warning("Error saving token storage: %s", e)
+        finally:
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+
+# Single file that held every user's tokens before the per-user files
+LEGACY_STORAGE_FILE = os.path.join(tempfile.gettempdir(), "streamlit_token_storage.json")
+
+def migrate_legacy_token_storage() -> None:
+    """Split the old all-users token file into per-user files, then delete it so no tokens linger there"""
+    try:
+        with open(LEGACY_STORAGE_FILE, 'rb') as f:
+            storage = _json_loads(f.read())
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        log.warning("Error loading legacy token storage, discarding it: %s", e)
+        storage = {}
+    if isinstance(storage, dict):
+        for user_id, record in storage.items():
+            # A newer per-user file wins over the legacy record
+            if user_id and isinstance(record, dict) and not os.path.exists(_user_token_path(user_id)):
+                # The raw token is no longer stored alongside its extracted fields
+                save_user_token(user_id, {k: v for k, v in record.items() if k != 'full_token'})
     try:
-        with open(STORAGE_FILE, 'w') as f:
-            json.dump(storage, f)
-        print(f"DEBUG: Saved token storage to {STORAGE_FILE}")
+        os.unlink(LEGACY_STORAGE_FILE)
+        log.debug("Migrated legacy token storage from %s", LEGACY_STORAGE_FILE)
+    except FileNotFoundError: # Another process migrated it first
+        pass
     except Exception as e:
-        print(f"DEBUG: Error saving token storage: {e}")
+        log.warning("Error removing legacy token storage: %s", e)
+
+migrate_legacy_token_storage()
+
+@st.cache_resource
+def _cached_oauth_client(provider: str):
+    """create_oauth_client per provider, built once per process (its server metadata is cached with it).
+    Held by st.cache_resource: an lru_cache here would be rebuilt empty by every rerun of this script.
+    Call _cached_oauth_client.clear() after changing the auth secrets."""
+    return create_oauth_client(provider)
 
 def enhanced_auth_callback_get(original_method):
     """Monkey patch for AuthCallbackHandler.get to capture full token information"""
@@ -43,26 +147,22 @@ def enhanced_auth_callback_get(original_method):
         if error:
             return await original_method(self)
 
-        client, _ = create_oauth_client(provider)
+        client, _ = _cached_oauth_client(provider)
         
         # Get the full token object (this is the key part!)
         token = client.authorize_access_token(self)
-        print("DEBUG: Token object:", token)
+        # Only field names are logged: the values are credentials
+        log.debug("Token fields: %s", token.keys())
         user = token.get("userinfo")
-        print("DEBUG: User object:", user)
+        log.debug("Userinfo present: %s", bool(user))
 
         if user:
             # Store the full token information in persistent storage
-            user_id = user.get('sub') or user.get('email') or user.get('oid')
-            print(f"DEBUG: Extracted user_id: {user_id}")
-            
-            # Load existing storage
-            token_storage = load_token_storage()
-            print(f"DEBUG: token_storage before assignment: {token_storage}")
+            user_id = _derive_user_id(user)
+            log.debug("Extracted user_id: %s", user_id)
             
             if user_id:
-                token_storage[user_id] = {
-                    'full_token': token,
+                record = {
                     'access_token': token.get('access_token'),
                     'id_token': token.get('id_token'),
                     'refresh_token': token.get('refresh_token'),
@@ -72,17 +172,17 @@ def enhanced_auth_callback_get(original_method):
                     'userinfo': user
                 }
                 
-                # Save to persistent storage
-                save_token_storage(token_storage)
-                print(f"DEBUG: Successfully stored token for user_id: {user_id}")
+                # Save to persistent storage; the file I/O runs on a worker thread so the IOLoop keeps serving
+                await asyncio.to_thread(save_user_token, user_id, record)
+                log.debug("Successfully stored token for user_id: %s", user_id)
             else:
-                print("DEBUG: user_id is None or empty!")
+                log.debug("user_id is None or empty!")
             
             # Continue with original Streamlit flow
             cookie_value = dict(user, origin=origin, is_logged_in=True)
             self.set_auth_cookie(cookie_value)
         else:
-            print("DEBUG: user is None or empty!")
+            log.debug("user is None or empty!")
         
         self.redirect_to_base()
     
@@ -97,23 +197,23 @@ def get_full_token_info() -> Dict[str, Any]:
     Get the full token information for the current user.
     This reuses Streamlit's existing user info to identify the user.
     """
-    token_storage = load_token_storage()
-    print(f"DEBUG: get_full_token_info called, token_storage: {token_storage}")
+    log.debug("get_full_token_info called")
     
+    # Checked first, so anonymous page views never touch the token files
     if not st.user.is_logged_in:
-        print("DEBUG: User not logged in")
+        log.debug("User not logged in")
         return {}
     
     # Use Streamlit's existing user identification
-    user_id = st.user.get('sub') or st.user.get('email') or st.user.get('oid')
-    print(f"DEBUG: Looking for user_id: {user_id}")
-    print(f"DEBUG: Available keys in token_storage: {list(token_storage.keys())}")
+    user_id = _derive_user_id(st.user)
+    log.debug("Looking for user_id: %s", user_id)
     
-    if user_id and user_id in token_storage:
-        print(f"DEBUG: Found token for user_id: {user_id}")
-        return token_storage[user_id]
+    token_info = load_user_token(user_id) if user_id else {}
+    if token_info:
+        log.debug("Found token for user_id: %s", user_id)
+        return token_info
     
-    print(f"DEBUG: No token found for user_id: {user_id}")
+    log.debug("No token found for user_id: %s", user_id)
     return {}
 
 def get_access_token() -> str:
@@ -126,14 +226,28 @@ def get_id_token() -> str:
     token_info = get_full_token_info()
     return token_info.get('id_token', '')
 
-def make_authenticated_api_call(api_url: str, headers: Dict[str, str] = None) -> Dict[str, Any]:
+def _mask(token: str) -> str:
+    """Only the first and last few characters, for display"""
+    return token if len(token) <= 20 else f"{token[:10]}...{token[-10:]}"
+
+@st.cache_resource
+def _api_session() -> requests.Session:
+    """Keep-alive session for API calls, so repeat calls to the same host skip the TCP/TLS handshake.
+    Built once per process and shared by every rerun, so its pooled connections are actually reused."""
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=32))
+    return session
+
+API_REQUEST_TIMEOUT = 10  # seconds, per connect and per read
+
+def make_authenticated_api_call(api_url: str, headers: Dict[str, str] = None,
+                                access_token: Optional[str] = None) -> Dict[str, Any]:
     """
     Make an API call using the stored access token.
     This demonstrates how to use the captured token for API calls.
+    Pass access_token when calling from a worker thread, where st.user is not available.
     """
-    import requests
-    
-    access_token = get_access_token()
+    access_token = access_token or get_access_token()
     if not access_token:
         return {"error": "No access token available"}
     
@@ -141,21 +255,47 @@ def make_authenticated_api_call(api_url: str, headers: Dict[str, str] = None) ->
     call_headers['Authorization'] = f'Bearer {access_token}'
     
     try:
-        response = requests.get(api_url, headers=call_headers)
+        response = _api_session().get(api_url, headers=call_headers, timeout=API_REQUEST_TIMEOUT)
         return response.json()
     except Exception as e:
         return {"error": str(e)}
 
 def clear_token_storage_for_user(user_id: str) -> None:
     """Clear token storage for a specific user"""
+    path = _user_token_path(user_id)
     try:
-        token_storage = load_token_storage()
-        if user_id in token_storage:
-            del token_storage[user_id]
-            save_token_storage(token_storage)
-            print(f"DEBUG: Cleared token storage for user_id: {user_id}")
+        with _storage_write_lock():
+            _token_cache().pop(path, None)
+            os.unlink(path)
+        log.debug("Cleared token storage for user_id: %s", user_id)
+    except FileNotFoundError:
+        pass
     except Exception as e:
-        print(f"DEBUG: Error clearing token storage: {e}")
+        log.warning("Error clearing token storage: %s", e)
+
+# Worker threads for API calls, so the rest of the page renders while a request is in flight.
+# One pool per process (st.cache_resource), shared by every rerun and session
+@st.cache_resource
+def _api_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=4)
+
+# The page has already rendered while we wait, so allow the full request timeout
+# (connect and read are bounded separately) rather than cutting slow responses short
+API_CALL_TIMEOUT = 2 * API_REQUEST_TIMEOUT
+
+def show_api_result(placeholder, future, api_url: str) -> None:
+    """Fill placeholder with the call's JSON, or a warning if it failed or timed out.
+    Successful results are kept in st.session_state so later reruns can show them again."""
+    try:
+        result = future.result(timeout=API_CALL_TIMEOUT)
+    except FutureTimeoutError:
+        placeholder.warning(f"No response from {api_url} within {API_CALL_TIMEOUT} seconds.")
+        return
+    except Exception as e:
+        placeholder.error(f"API call failed: {e}")
+        return
+    st.session_state.setdefault('api_results', {})[api_url] = result
+    placeholder.json(result)
 
 # Streamlit UI
 st.title("Enhanced Streamlit Authentication with Full Token Access")
@@ -165,29 +305,30 @@ if not st.user.is_logged_in:
     if st.button("Log in"):
         st.login()
 else:
-    st.success(f"Welcome back, {st.user.get('name', 'User')}!")
+    # Plain-dict copy of the claims, read once; the rest of the page reads this instead of the st.user proxy
+    user_claims = dict(st.user)
+    st.success(f"Welcome back, {user_claims.get('name', 'User')}!")
     
     # Display standard Streamlit user info
     st.subheader("Standard Streamlit User Info")
-    st.json(dict(st.user))
+    st.json(user_claims)
     
     # Display enhanced token information
     st.subheader("Enhanced Token Information")
+    # Looked up once per run; the fields below are read from this dict
     token_info = get_full_token_info()
     
     if token_info:
         st.write("**Access Token:**")
-        access_token = get_access_token()
+        access_token = token_info.get('access_token', '')
         if access_token:
             # Only show first and last few characters for security
-            masked_token = f"{access_token[:10]}...{access_token[-10:]}" if len(access_token) > 20 else access_token
-            st.code(masked_token)
+            st.code(_mask(access_token))
         
         st.write("**ID Token:**")
-        id_token = get_id_token()
+        id_token = token_info.get('id_token', '')
         if id_token:
-            masked_id_token = f"{id_token[:10]}...{id_token[-10:]}" if len(id_token) > 20 else id_token
-            st.code(masked_id_token)
+            st.code(_mask(id_token))
         
         st.write("**Full Token Structure:**")
         # Create a safe version without actual token values for display
@@ -204,36 +345,52 @@ else:
         # Example API call section
         st.subheader("Example: Make Authenticated API Call")
         st.write("You can now use the access token to make authenticated API calls:")
+        # Calls started by the buttons below: (placeholder, future, url), filled in once the page is rendered
+        pending_calls = []
+        # Results of earlier calls this session, shown again until the button is clicked anew
+        api_results = st.session_state.get('api_results', {})
         
         # Example for Google APIs if using Google OAuth
-        if 'accounts.google.com' in st.user.get('iss', ''):
+        issuer = user_claims.get('iss', '')
+        if 'accounts.google.com' in issuer:
+            profile_url = "https://www.googleapis.com/oauth2/v2/userinfo"
             if st.button("Get Google User Profile"):
-                profile_data = make_authenticated_api_call(
-                    "https://www.googleapis.com/oauth2/v2/userinfo"
-                )
-                st.json(profile_data)
+                pending_calls.append((st.empty(), _api_executor().submit(
+                    make_authenticated_api_call, profile_url, access_token=access_token
+                ), profile_url))
+            elif profile_url in api_results:
+                st.json(api_results[profile_url])
         
         # Example for Microsoft Graph API if using Microsoft OAuth
-        elif 'login.microsoftonline.com' in st.user.get('iss', ''):
+        elif 'login.microsoftonline.com' in issuer:
+            profile_url = "https://graph.microsoft.com/v1.0/me"
             if st.button("Get Microsoft User Profile"):
-                profile_data = make_authenticated_api_call(
-                    "https://graph.microsoft.com/v1.0/me"
-                )
-                st.json(profile_data)
+                pending_calls.append((st.empty(), _api_executor().submit(
+                    make_authenticated_api_call, profile_url, access_token=access_token
+                ), profile_url))
+            elif profile_url in api_results:
+                st.json(api_results[profile_url])
         
         # Custom API endpoint
         st.write("**Custom API Call:**")
         api_url = st.text_input("Enter API URL:", placeholder="https://api.example.com/user")
         if st.button("Make API Call") and api_url:
-            api_data = make_authenticated_api_call(api_url)
-            st.json(api_data)
+            pending_calls.append((st.empty(), _api_executor().submit(
+                make_authenticated_api_call, api_url, access_token=access_token
+            ), api_url))
+        elif api_url in api_results:
+            st.json(api_results[api_url])
+        
+        for placeholder, future, url in pending_calls:
+            show_api_result(placeholder, future, url)
     
     else:
         st.warning("Token information not available. Please log out and log in again.")
     
     if st.button("Log out"):
         # Clear our token storage when user logs out
-        user_id = st.user.get('sub') or st.user.get('email') or st.user.get('oid')
+        user_id = _derive_user_id(user_claims)
         if user_id:
             clear_token_storage_for_user(user_id)
+        st.session_state.pop('api_results', None)
         st.logout()
@@ -15,6 +15,10 @@ from new_silent_login import (
     logout_current_user
 )
 
+def _markdown_fields(fields: dict) -> str:
+    """One markdown block of '**label:** value' lines, so a group of fields is a single element."""
+    return "  \n".join(f"**{label}:** {value}" for label, value in fields.items())
+
 def main():
     """Main application demonstrating secure silent login."""
     st.set_page_config(
@@ -39,17 +43,15 @@ def main():
             # Show user info without triggering login
             user_info = get_current_user_info(app_name)
             if user_info:
-                st.write(f"**Email:** {user_info.get('email_address', 'N/A')}")
-                st.write(f"**Name:** {user_info.get('first_name', '')} {user_info.get('last_name', '')}")
-                st.write(f"**UID:** {user_info.get('uid', 'N/A')}")
-                st.write(f"**Team:** {user_info.get('team_id', 'N/A')}")
-                
                 # Check access token
                 access_token = get_current_access_token()
-                if access_token:
-                    st.write(f"**Token:** {access_token[:20]}...✅")
-                else:
-                    st.write("**Token:** ❌ No valid token")
+                st.markdown(_markdown_fields({
+                    "Email": user_info.get('email_address', 'N/A'),
+                    "Name": f"{user_info.get('first_name', '')} {user_info.get('last_name', '')}",
+                    "UID": user_info.get('uid', 'N/A'),
+                    "Team": user_info.get('team_id', 'N/A'),
+                    "Token": f"{access_token[:20]}...✅" if access_token else "❌ No valid token",
+                }))
             
             # Logout button
             if st.button("🚪 Logout", use_container_width=True):
@@ -120,8 +122,7 @@ def main():
                             f"Access to {app_name}": user_info.get(app_name, 'None')
                         }
                         
-                        for key, value in user_display.items():
-                            st.write(f"**{key}:** {value}")
+                        st.markdown(_markdown_fields(user_display))
                     else:
                         if is_user_authenticated():
                             st.warning("⚠️ User authenticated but not in database")
@@ -180,19 +181,19 @@ def main():
             # Count active sessions (secure - only visible within process)
             active_sessions = len(session_store._sessions)
             
-            st.metric("Active Sessions", active_sessions)
-            st.metric("Authentication Status", "✅ Authenticated")
-            
             # Show token expiry if available
             user_data = get_current_user_info(app_name)
-            if user_data:
-                st.metric("User in Database", "✅ Yes")
-            else:
-                st.metric("User in Database", "❌ No")
+            st.markdown(_markdown_fields({
+                "Active Sessions": active_sessions,
+                "Authentication Status": "✅ Authenticated",
+                "User in Database": "✅ Yes" if user_data else "❌ No",
+            }))
         else:
-            st.metric("Active Sessions", "0")
-            st.metric("Authentication Status", "❌ Not Authenticated")
-            st.metric("User in Database", "❓ Unknown")
+            st.markdown(_markdown_fields({
+                "Active Sessions": 0,
+                "Authentication Status": "❌ Not Authenticated",
+                "User in Database": "❓ Unknown",
+            }))
     
     # Migration guide
     st.subheader("🔄 Migration from Old Method")
@@ -236,8 +237,7 @@ def main():
         "Audit Trail": "✅ Proper logging without exposing sensitive data"
     }
     
-    for feature, description in security_features.items():
-        st.write(f"**{feature}:** {description}")
+    st.markdown(_markdown_fields(security_features))
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file